@@ -0,0 +1,141 @@
+import asyncio
+import atexit
+import os
+import ssl
+import time
+from functools import wraps
+from threading import Lock
+from typing import Any, Awaitable, Callable, ParamSpec, TypeVar
+
+import httpx
+from loguru import logger
+
+from .config import config
+
+# every request to the router shares these, so the router url, the node's
+# eth address header and the transport settings live in one place
+_OPTIONS: dict[str, Any] = {
+    "base_url": config.router_url,
+    "headers": {"X-ETH-ADDRESS": config.node.eth_address},
+    "timeout": 10,
+    "follow_redirects": True,
+}
+
+# one tls context is shared by every client instead of each transport
+# building its own. Certificates aren't verified, as before. httpcore sets
+# the ALPN protocols, h2 included when http2 is on, on the context itself
+_SSL_CONTEXT = ssl.create_default_context()
+_SSL_CONTEXT.check_hostname = False
+_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+# with the zstd extra installed, httpx offers zstd next to gzip in its
+# default Accept-Encoding and decodes either transparently
+_TRANSPORT_OPTIONS: dict[str, Any] = {
+    "http2": True,
+    "retries": 3,
+    "verify": _SSL_CONTEXT,
+}
+
+# long lived keep-alive connections get closed by the router or middleboxes
+# while idle. The transport only retries failed connects, so requests that
+# hit an already dropped connection are retried here, with a backoff. A read
+# error can come after the router got the request, so only idempotent calls
+# (GET, PUT, DELETE) are retried, never POSTs
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.05
+_RETRY_ERRORS = (httpx.RemoteProtocolError, httpx.ReadError)
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+# httpx's own default connection pool limits
+DEFAULT_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+
+# file transfers fan out over many concurrent requests, so their clients keep
+# more connections alive between calls
+FILE_TRANSFER_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+
+
+def new_async_client(limits: httpx.Limits = DEFAULT_LIMITS) -> httpx.AsyncClient:
+    """Creates an async client for the router. Its connections belong to
+    the event loop it is first used on, so it can't be shared across loops.
+
+    Args:
+        limits (httpx.Limits): the connection pool limits
+    """
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(limits=limits, **_TRANSPORT_OPTIONS),
+        **_OPTIONS,
+    )
+
+
+def per_process(factory: Callable[[], T]) -> Callable[[], T]:
+    """Returns an accessor that calls the factory once per process, on first
+    use. Clients and threads aren't safe to inherit across a fork, so a
+    worker process forked from the node gets its own instead of the parent's.
+
+    Args:
+        factory (Callable[[], T]): creates the per process instance
+    """
+    lock = Lock()
+    instances: dict[int, T] = {}
+
+    @wraps(factory)
+    def get() -> T:
+        pid = os.getpid()
+        if pid not in instances:
+            with lock:
+                if pid not in instances:
+                    instances[pid] = factory()
+        return instances[pid]
+
+    return get
+
+
+@per_process
+def get_client() -> httpx.Client:
+    """Returns the keep-alive client shared by every synchronous router call,
+    so requests reuse connections instead of paying a TCP + TLS handshake each.
+    """
+    client = httpx.Client(
+        transport=httpx.HTTPTransport(
+            limits=FILE_TRANSFER_LIMITS, **_TRANSPORT_OPTIONS
+        ),
+        **_OPTIONS,
+    )
+    atexit.register(client.close)
+    return client
+
+
+def resilient(fn: Callable[P, T]) -> Callable[P, T]:
+    """Retries the wrapped router call when its connection was dropped. Only
+    for idempotent calls, which can safely reach the router twice."""
+
+    @wraps(fn)
+    def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+        for attempt in range(RETRY_ATTEMPTS - 1):
+            try:
+                return fn(*args, **kwargs)
+            except _RETRY_ERRORS as e:
+                logger.warning(f"Retrying {fn.__name__} after dropped connection: {e}")
+                time.sleep(RETRY_BACKOFF * 2**attempt)
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def resilient_async(fn: Callable[P, Awaitable[T]]) -> Callable[P, Awaitable[T]]:
+    """Retries the wrapped async router call when its connection was dropped.
+    Only for idempotent calls, which can safely reach the router twice."""
+
+    @wraps(fn)
+    async def wrapper(*args: P.args, **kwargs: P.kwargs) -> T:
+        for attempt in range(RETRY_ATTEMPTS - 1):
+            try:
+                return await fn(*args, **kwargs)
+            except _RETRY_ERRORS as e:
+                logger.warning(f"Retrying {fn.__name__} after dropped connection: {e}")
+                await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+        return await fn(*args, **kwargs)
+
+    return wrapper
@@ -1,24 +1,63 @@
 from __future__ import annotations
 
+import hashlib
+import pickle
+import tomllib
 from pathlib import Path
 
-from box import Box
+import pydantic
 
+from . import types
 from .types import Config, Host, NodeDef, Spec
 
 
+def config_cache_version() -> str:
+    # cached configs are only valid for the code that parsed them, so the
+    # cache is keyed on the parsing code and the config types themselves,
+    # along with the pydantic version that pickled them
+    digest = hashlib.sha256(pydantic.VERSION.encode())
+    for module in (__file__, types.__file__):
+        digest.update(Path(module).read_bytes())
+    return digest.hexdigest()
+
+
 def load_config(path: Path) -> Config:
-    data = Box.from_toml(filename=path)
+    # the parsed config is cached next to the toml file, keyed by the toml
+    # file's mtime and size, so unchanged configs skip parsing entirely
+    stat = path.stat()
+    key = (config_cache_version(), stat.st_mtime_ns, stat.st_size)
+    cache_path = path.with_name(f"{path.name}.pkl")
+    try:
+        with open(cache_path, "rb") as f:
+            cached_key, cached_config = pickle.load(f)
+        if cached_key == key and isinstance(cached_config, Config):
+            return cached_config
+    except Exception:
+        # a missing, stale or unreadable cache just means parsing the toml
+        pass
+
+    config = parse_config(path)
+    try:
+        with open(cache_path, "wb") as f:
+            pickle.dump((key, config), f)
+    except OSError:
+        pass
+    return config
+
+
+def parse_config(path: Path) -> Config:
+    with open(path, "rb") as f:
+        data = tomllib.load(f)
 
-    router_url = data.router_url
-    compute_node = data.compute_node
-    float_types = data.float_types
-    host = data.host
+    router_url = data["router_url"]
+    compute_node = data["compute_node"]
+    float_types = data["float_types"]
+    host = data["host"]
 
     spec = Spec(
         # Assuming RAM and VRAM are provided as "XXGB"
-        ram=int(compute_node.ram.replace("GB", "")),
-        vram=int(compute_node.vram.replace("GB", "")),
+        ram=int(compute_node["ram"].replace("GB", "")),
+        vram=int(compute_node["vram"].replace("GB", "")),
         FP80=float_types.get("FP80", False),
         FP64=float_types.get("FP64", False),
         FP32=float_types.get("FP32", False),
@@ -33,14 +72,14 @@ def load_config(path: Path) -> Config:
     return Config(
         router_url=router_url,
         host=Host(
-            external_port=host.external_port,
-            local_only=host.local_only,
-            app_dir=host.app_dir,
+            external_port=host["external_port"],
+            local_only=host.get("local_only", False),
+            app_dir=host["app_dir"],
         ),
         node=NodeDef(
-            eth_address=compute_node.eth_address,
-            cpu=compute_node.cpu,
-            gpu=compute_node.gpu,
+            eth_address=compute_node["eth_address"],
+            cpu=compute_node.get("cpu"),
+            gpu=compute_node.get("gpu"),
             spec=spec,
         ),
     )
@@ -1,8 +1,18 @@
+import asyncio
+import atexit
+from threading import Thread
+
 import httpx
 from loguru import logger
 from pydantic import BaseModel
 
-from .config import config
+from .client import (
+    get_client,
+    new_async_client,
+    per_process,
+    resilient,
+    resilient_async,
+)
 from .exceptions import (
     AppFailedToInstallException,
     AppFailedToUninstallException,
@@ -13,44 +23,123 @@ from .exceptions import (
 from .store import store
 from .types import App, Config, Job, JobState, Node, NodeDef, NodeState, Result
 
+# request bodies are serialized straight to json with model_dump_json
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# how long the state loop waits for more updates before sending a batch
+STATE_BATCH_WINDOW = 0.005
+
+
+class StateSender:
+    """Sends job and node state updates fire-and-forget: they are queued
+    onto a background event loop and sent over one HTTP/2 connection, so
+    callers never wait on a router round-trip.
+    """
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.async_client = new_async_client()
+        self.queue: asyncio.Queue[tuple[str, str]] = asyncio.Queue()
+        Thread(target=self.loop.run_forever, name="state-updates", daemon=True).start()
+        self.task = asyncio.run_coroutine_threadsafe(self.send_updates(), self.loop)
+        atexit.register(self.close)
+
+    def submit(self, url: str, payload: str) -> None:
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (url, payload))
+
+    def flush(self, timeout: float | None = None) -> None:
+        asyncio.run_coroutine_threadsafe(self.queue.join(), self.loop).result(timeout)
+
+    def close(self) -> None:
+        # closing stops the loop, so a sender closed early mustn't be closed
+        # again at exit
+        atexit.unregister(self.close)
+        self.flush(timeout=10)
+        self.task.cancel()
+        asyncio.run_coroutine_threadsafe(self.async_client.aclose(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def send_updates(self) -> None:
+        while True:
+            # coalesce updates to the same url, only the latest state matters.
+            # A url updated again moves to the back, so the updates keep the
+            # order of their latest submission
+            url, payload = await self.queue.get()
+            updates = {url: payload}
+            received = 1
+            await asyncio.sleep(STATE_BATCH_WINDOW)
+            while not self.queue.empty():
+                url, payload = self.queue.get_nowait()
+                updates.pop(url, None)
+                updates[url] = payload
+                received += 1
+
+            # sent one after another, since the router must see e.g. a job
+            # finished before the node goes idle and is given the next one
+            for url, payload in updates.items():
+                try:
+                    response = await self.put(url, payload)
+                except Exception as e:
+                    logger.error(f"Failed to send state update to {url}: {e}")
+                    continue
+                if response.is_error:
+                    logger.error(
+                        f"Failed to send state update to {url}: {response.status_code}"
+                    )
+            for _ in range(received):
+                self.queue.task_done()
+
+    @resilient_async
+    async def put(self, url: str, payload: str) -> httpx.Response:
+        return await self.async_client.put(url, content=payload, headers=_JSON_HEADERS)
+
+
+# the sender's loop thread doesn't survive a fork, so each process starts
+# its own on first use
+state_sender = per_process(StateSender)
+
+
+def flush_state_updates(timeout: float | None = None) -> None:
+    """Blocks until every queued state update has been sent to the router."""
+    state_sender().flush(timeout)
+
 
 class RegisterDTO(BaseModel):
     port: int
     node: NodeDef
 
 
+class NodeStateDTO(BaseModel):
+    node_id: str
+    state: NodeState
+
+
 class AppErrorReportDTO(BaseModel):
     error: str
     type: str = "INSTALL_ERROR"
 
 
 def register(config: Config) -> None:
-    transport = httpx.HTTPTransport(retries=3, verify=False)
-    with httpx.Client(transport=transport) as client:
-        response = client.post(
-            f"{config.router_url}/node",
-            headers={"X-ETH-ADDRESS": config.node.eth_address},
-            json=RegisterDTO(
-                port=config.host.external_port,
-                node=config.node,
-            ).model_dump(),
-            timeout=10,
-            follow_redirects=True,
-        )
-        if response.status_code != 201:
-            logger.error("Failed to register with router")
-            raise NodeRegistrationFailureException("Failed to register with router")
-        node = Node(**response.json())
-        store.node = node
+    response = get_client().post(
+        "/node",
+        content=RegisterDTO(
+            port=config.host.external_port,
+            node=config.node,
+        ).model_dump_json(),
+        headers=_JSON_HEADERS,
+    )
+    if response.status_code != 201:
+        logger.error("Failed to register with router")
+        raise NodeRegistrationFailureException("Failed to register with router")
+    node = Node(**response.json())
+    store.node = node
+    store.node_path = f"/node/{node.id}"
     logger.info(f"Registered with router successfully. Node ID: {node.id}")
 
 
+@resilient
 def get_app(app_id: str) -> App:
-    response = httpx.get(
-        f"{config.router_url}/app/{app_id}",
-        headers={"X-ETH-ADDRESS": config.node.eth_address},
-        verify=False,
-    )
+    response = get_client().get(f"/app/{app_id}")
     response.raise_for_status()
     app_data = response.json()
     if not app_data:
@@ -77,52 +166,50 @@ def set_job_finishing(job: Job) -> None:
 
 def set_job_finished(job: Job) -> None:
     set_job_state(job, JobState.FINISHED)
+    # unlike the other job states, the router has to see this one before
+    # the job is done with
+    flush_state_updates()
 
 
 def set_job_state(job: Job, state: JobState) -> None:
     job.state = state
-    response = httpx.put(
-        f"{config.router_url}/job/{job.id}",
-        headers={"X-ETH-ADDRESS": config.node.eth_address},
-        json=job.model_dump(),
-        verify=False,
-    )
-    response.raise_for_status()
+    state_sender().submit(f"/job/{job.id}", job.model_dump_json())
     logger.info(f"Job {job.id} state set to {state.name}")
 
 
 def upload_result(result: Result) -> None:
-    response = httpx.post(
-        f"{config.router_url}/job/{result.job_id}/result",
-        headers={"X-ETH-ADDRESS": config.node.eth_address},
-        json=result.model_dump(),
-        verify=False,
+    # make sure the router has seen the job's state changes before its result
+    flush_state_updates()
+    response = get_client().post(
+        f"/job/{result.job_id}/result",
+        content=result.model_dump_json(),
+        headers=_JSON_HEADERS,
     )
     response.raise_for_status()
     logger.info(f"Result for job {result.job_id} uploaded")
 
 
+@resilient
 def report_failed_app_install(app_id: str, error: AppFailedToInstallException) -> None:
     app_error_report_dto = AppErrorReportDTO(error=str(error), type="INSTALL_ERROR")
-    response = httpx.put(
-        f"{config.router_url}/app/{app_id}",
-        headers={"X-ETH-ADDRESS": config.node.eth_address},
-        json=app_error_report_dto.model_dump(),
-        verify=False,
+    response = get_client().put(
+        f"/app/{app_id}",
+        content=app_error_report_dto.model_dump_json(),
+        headers=_JSON_HEADERS,
     )
     response.raise_for_status()
     logger.error(f"Failed to install app {app_id}: {error}")
 
 
+@resilient
 def report_failed_app_uninstall(
     app_id: str, error: AppFailedToUninstallException
 ) -> None:
     app_error_report_dto = AppErrorReportDTO(error=str(error), type="UNINSTALL_ERROR")
-    response = httpx.put(
-        f"{config.router_url}/app/{app_id}",
-        headers={"X-ETH-ADDRESS": config.node.eth_address},
-        json=app_error_report_dto.model_dump(),
-        verify=False,
+    response = get_client().put(
+        f"/app/{app_id}",
+        content=app_error_report_dto.model_dump_json(),
+        headers=_JSON_HEADERS,
     )
     response.raise_for_status()
     logger.error(f"Failed to uninstall app {app_id}: {error}")
@@ -137,43 +224,29 @@ def set_node_idle() -> None:
 
 
 def set_node_state(state: NodeState) -> None:
-    class NodeStateDTO(BaseModel):
-        node_id: str
-        state: NodeState
-
     if not store.node:
         raise NodeNotFoundException("Node not found")
     store.state = state
     logger.info(f"Node state set to {state.name}")
     node_state_dto = NodeStateDTO(node_id=store.node.id, state=state)
-    response = httpx.put(
-        f"{config.router_url}/node/state",
-        headers={"X-ETH-ADDRESS": config.node.eth_address},
-        json=node_state_dto.model_dump(),
-        verify=False,
-    )
-    response.raise_for_status()
+    state_sender().submit("/node/state", node_state_dto.model_dump_json())
 
 
+@resilient
 def add_app(app_id: str) -> None:
-    if not store.node:
+    store.apps_changed()
+    if not store.node_path:
         raise NodeNotFoundException("Node not found")
-    response = httpx.put(
-        f"{config.router_url}/node/{store.node.id}/app/{app_id}",
-        headers={"X-ETH-ADDRESS": config.node.eth_address},
-        verify=False,
-    )
+    response = get_client().put(f"{store.node_path}/app/{app_id}")
     response.raise_for_status()
-    logger.info(f"App {app_id} added to node {store.node.id}")
+    logger.info(f"App {app_id} added to {store.node_path}")
 
 
+@resilient
 def remove_app(app_id: str) -> None:
-    if not store.node:
+    store.apps_changed()
+    if not store.node_path:
         raise NodeNotFoundException("Node not found")
-    response = httpx.delete(
-        f"{config.router_url}/node/{store.node.id}/app/{app_id}",
-        headers={"X-ETH-ADDRESS": config.node.eth_address},
-        verify=False,
-    )
+    response = get_client().delete(f"{store.node_path}/app/{app_id}")
     response.raise_for_status()
-    logger.info(f"App {app_id} removed from node {store.node.id}")
+    logger.info(f"App {app_id} removed from {store.node_path}")
@@ -20,3 +20,7 @@ class AppFailedToInstallException(Exception):
 
 class AppFailedToUninstallException(Exception):
     pass
+
+
+class FilesFailedToUploadException(Exception):
+    pass
@@ -1,30 +1,111 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+import queue
+import signal
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from threading import Thread
+from typing import Any, Callable
 
 from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
 
 from . import crud, node
 from .config import config
 from .store import store
-from .types import Job, NodeState
+from .types import Job, NodeState, Result
+from .worker import Worker, job_queue, result_queue
 
 logging.basicConfig(level=logging.INFO)
 
+# installs and uninstalls run on a bounded pool of worker threads rather
+# than a new thread per request. Jobs run in the worker process
+MAX_QUEUED_WORK = 16
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="node-work")
+
+# how often, in seconds, the worker process is checked on while no results
+# arrive
+WORKER_CHECK_INTERVAL = 1
+
+
+def submit_work(fn: Callable[..., Any], *args: Any) -> None:
+    if _executor._work_queue.qsize() >= MAX_QUEUED_WORK:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Node has too much queued work",
+        )
+    _executor.submit(fn, *args)
+
+
+async def report_results(worker: Worker) -> None:
+    # the worker process sends back each job's result, which is reported
+    # from here so the node's state stays in this process
+    while True:
+        try:
+            item = await asyncio.to_thread(
+                result_queue.get, timeout=WORKER_CHECK_INTERVAL
+            )
+        except queue.Empty:
+            # a worker that exited cleanly was stopped, and the None that
+            # ends the results follows
+            if worker.is_alive() or worker.exitcode == 0:
+                continue
+            await report_dead_worker(worker)
+            return
+        if item is None:
+            return
+        job, result = item
+        store.job = None
+        try:
+            await asyncio.to_thread(node.finish_job, job, result)
+        except Exception as e:
+            logging.error(f"Failed to report the result of job {job.id}: {e}")
+
+
+async def report_dead_worker(worker: Worker) -> None:
+    """Fails the job the worker was running when its process died, e.g.
+    killed for running out of memory, and shuts the node down.
+
+    Args:
+        worker (Worker): the dead worker
+    """
+    error = f"Worker process died with exit code {worker.exitcode}"
+    logging.error(error)
+    job, store.job = store.job, None
+    if job is not None:
+        result = Result(job_id=job.id, execution_time=0, success=False, error=error)
+        try:
+            await asyncio.to_thread(node.finish_job, job, result)
+        except Exception as e:
+            logging.error(f"Failed to report the result of job {job.id}: {e}")
+    # a process killed while waiting on a queue can leave the queue locked,
+    # so no new worker is started on them. The node shuts down instead, and
+    # its service restarts it with a fresh worker
+    signal.raise_signal(signal.SIGTERM)
+
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
     logging.info("Node startup")
 
-    if config.host.local_only:
-        yield
-        return
+    if not config.host.local_only:
+        crud.register(config)
 
-    crud.register(config)
+    worker = Worker(job_queue, result_queue)
+    worker.start()
+    results = asyncio.create_task(report_results(worker))
     yield
 
+    # let any running install, uninstall or job finish before exiting. The
+    # queue puts block while a queue is full, so they run off the event loop
+    if worker.is_alive():
+        await asyncio.to_thread(worker.stop)
+        await asyncio.to_thread(worker.join)
+    if not results.done():
+        await asyncio.to_thread(result_queue.put, None)
+    await results
+    _executor.shutdown(wait=True)
+
 
 app = FastAPI(lifespan=lifespan)
 
@@ -65,7 +146,7 @@ async def install_app(app_id: str, _: Request) -> None:
             detail="App is already installed",
         )
 
-    Thread(target=node.install_app, args=(app_id,), daemon=True).start()
+    submit_work(node.install_app, app_id)
 
 
 @app.delete(
@@ -87,7 +168,7 @@ async def uninstall_app(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="App is not installed",
         )
-    Thread(target=node.uninstall_app, args=(app_id,), daemon=True).start()
+    submit_work(node.uninstall_app, app_id)
 
 
 @app.post(
@@ -107,6 +188,14 @@ async def create_job(job: Job, _: Request):
             status_code=status.HTTP_404_NOT_FOUND,
             detail="App is not installed",
         )
+    crud.set_node_busy()
+    try:
+        job_queue.put_nowait(job)
+    except queue.Full:
+        crud.set_node_idle()
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Node already has a job queued",
+        )
     store.job = job
-    Thread(target=node.run_job, args=(job,), daemon=True).start()
     return job.model_dump()
@@ -1,25 +1,64 @@
 from __future__ import annotations
 
-import mimetypes
+import fcntl
+import hashlib
+import os
+import re
 import shutil
 import subprocess
+import sys
+import tempfile
 import time
+from contextlib import contextmanager
 from pathlib import Path
+from typing import BinaryIO, Iterator
+from venv import EnvBuilder
 
-import httpx
 from loguru import logger
-from tqdm.contrib.concurrent import thread_map
 
 from . import crud
-from .config import config
 from .exceptions import AppFailedToInstallException, AppFailedToUninstallException
-from .types import File, Job, Result
+from .types import App, Job, Result
+from .util import (
+    clear_directory,
+    download_files,
+    fast_rmtree,
+    get_app_directory,
+    list_files,
+    upload_files,
+)
+
+# virtual environment templates, keyed by requirements, live in this
+# directory of the app directory
+TEMPLATE_DIRECTORY = ".templates"
+
+# requirement lines starting with these refer to local paths or other
+# files, so apps with them don't share a template
+_LOCAL_REQUIREMENT_PREFIXES = (
+    "-e",
+    "--editable",
+    "-r",
+    "--requirement",
+    "-c",
+    "--constraint",
+    "-f",
+    "--find-links",
+    ".",
+    "/",
+    "~",
+)
+
+# at most this much of a job's stdout and stderr is reported in its result
+MAX_OUTPUT_BYTES = 1 << 16
 
 
 def install_app(app_id: str) -> None:  # sourcery skip: extract-method
     """Downloads the app and its dependencies.
-    Apps use python 3.10 and pip to install dependencies into a
-    virtual environment in the app directory.
+    Apps get a virtual environment in the app directory, built from the
+    node's own python, and their dependencies are installed into it with
+    uv when it is available, falling back to pip. Apps with the same
+    self-contained requirements share a template environment, hardlinked
+    into each app.
 
     Args:
         app (App): the app to install
@@ -43,30 +82,15 @@ def install_app(app_id: str) -> None:  # sourcery skip: extract-method
     try:
         app_path.mkdir(parents=True, exist_ok=True, mode=0o777)
 
-        # create a virtual environment
-        logger.info(f"Creating virtual environment for app {app.name}")
-        subprocess.run(["python3.11", "-m", "venv", app_path / ".venv"])
-        logger.info(f"Virtual environment created for app {app.name}")
-
         download_files(app.files, app_path)
 
-        # install app dependencies
-        if (app_path / "requirements.txt").exists():
-            logger.info(
-                f"requirements.txt exists for app {app.name}, installing dependencies"
-            )
-            subprocess.run(
-                [
-                    ".venv/bin/pip",
-                    "install",
-                    "-r",
-                    "requirements.txt",
-                ],
-                cwd=app_path,
-            )
-            logger.info(f"Dependencies installed for app {app.name}")
+        venv_path = app_path / ".venv"
+        requirements = app_path / "requirements.txt"
+        template = venv_template(requirements) if requirements.exists() else None
+        if template:
+            link_template(app, template, requirements, venv_path)
         else:
-            logger.info(f"App {app.name} has no dependencies")
+            create_venv(app, venv_path, requirements)
     except Exception as e:
         logger.error(f"Failed to install app {app.name}: {e}")
         crud.report_failed_app_install(app.id, AppFailedToInstallException(str(e)))
@@ -74,6 +98,130 @@ def install_app(app_id: str) -> None:  # sourcery skip: extract-method
     crud.set_node_idle()
 
 
+def create_venv(app: App, venv_path: Path, requirements: Path) -> None:
+    """Creates the app's virtual environment and installs its requirements.
+
+    Args:
+        app (App): the app being installed
+        venv_path (Path): where to create the virtual environment
+        requirements (Path): the app's requirements.txt, which may not exist
+    """
+    # uv creates the virtual environment and installs into it from its
+    # shared cache, hardlinking packages instead of copying them. Without
+    # uv the environment is created in-process and pip installs into it
+    uv = shutil.which("uv")
+    logger.info(f"Creating virtual environment for app {app.name}")
+    if uv:
+        subprocess.run(
+            [uv, "venv", "--python", sys.executable, str(venv_path)], check=True
+        )
+    else:
+        EnvBuilder(with_pip=True, symlinks=True).create(venv_path)
+    logger.info(f"Virtual environment created for app {app.name}")
+
+    # install app dependencies
+    if not requirements.exists():
+        logger.info(f"App {app.name} has no dependencies")
+        return
+    logger.info(f"requirements.txt exists for app {app.name}, installing dependencies")
+    python = venv_path / "bin" / "python"
+    if uv:
+        command = [uv, "pip", "install", "--python", python, "--link-mode=hardlink"]
+    else:
+        command = [python, "-m", "pip", "install", "--prefer-binary"]
+    # relative entries, like -e ., resolve against the app's directory
+    subprocess.run([*command, "-r", requirements], cwd=requirements.parent, check=True)
+    logger.info(f"Dependencies installed for app {app.name}")
+
+
+def venv_template(requirements: Path) -> Path | None:
+    """Returns where the virtual environment template for these requirements
+    lives, whether or not it has been built yet. Templates are kept in the
+    app directory, next to the apps, so they can be hardlinked. Returns None
+    when the requirements point at other files, like -e . or -r, which the
+    template couldn't be keyed on.
+
+    Args:
+        requirements (Path): the app's requirements.txt
+    """
+    content = requirements.read_bytes()
+    for line in content.decode(errors="replace").splitlines():
+        line = re.sub(r"(^|\s)#.*", "", line).strip()
+        if line.startswith(_LOCAL_REQUIREMENT_PREFIXES) or "file:" in line:
+            return None
+    # environments built by a different python aren't interchangeable
+    digest = hashlib.sha256(sys.version.encode())
+    digest.update(content)
+    return get_app_directory() / TEMPLATE_DIRECTORY / digest.hexdigest()
+
+
+def link_template(app: App, template: Path, requirements: Path, venv_path: Path):
+    """Hardlinks the template into the app's virtual environment, building
+    the template first if no app installed these requirements before. It is
+    built in place, so its scripts point at the template itself rather than
+    at the app it was first built for.
+
+    Args:
+        app (App): the app being installed
+        template (Path): the template's path
+        requirements (Path): the app's requirements.txt
+        venv_path (Path): where to link the virtual environment
+    """
+    template.parent.mkdir(exist_ok=True)
+    ready = template.with_name(f"{template.name}.ready")
+    with template_lock(template):
+        if ready.exists():
+            logger.info(f"Reusing virtual environment template for app {app.name}")
+        else:
+            # a template without its marker is left over from a build that
+            # was interrupted
+            shutil.rmtree(template, ignore_errors=True)
+            try:
+                create_venv(app, template, requirements)
+            except Exception:
+                shutil.rmtree(template, ignore_errors=True)
+                raise
+            ready.touch()
+        link_tree(template, venv_path)
+
+
+def prune_templates() -> None:
+    """Removes the templates no installed app is linked to anymore. Every
+    app built from a template hardlinks its pyvenv.cfg, so a template whose
+    pyvenv.cfg has no other links is unused.
+    """
+    templates = get_app_directory() / TEMPLATE_DIRECTORY
+    if not templates.exists():
+        return
+    with os.scandir(templates) as entries:
+        names = [e.name for e in entries if e.is_dir(follow_symlinks=False)]
+    for name in names:
+        template = templates / name
+        ready = template.with_name(f"{template.name}.ready")
+        with template_lock(template):
+            pyvenv = template / "pyvenv.cfg"
+            if ready.exists() and pyvenv.exists() and pyvenv.stat().st_nlink > 1:
+                continue
+            logger.info(f"Removing unused virtual environment template {name}")
+            ready.unlink(missing_ok=True)
+            shutil.rmtree(template, ignore_errors=True)
+
+
+@contextmanager
+def template_lock(template: Path) -> Iterator[None]:
+    # serializes building, linking and pruning a template across processes.
+    # The lock files are kept, since removing one could let two processes
+    # lock different files of the same name
+    with open(template.with_name(f"{template.name}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def link_tree(source: Path, destination: Path) -> None:
+    # symlinks, like the venv's python, are copied as symlinks
+    shutil.copytree(source, destination, symlinks=True, copy_function=os.link)
+
+
 def uninstall_app(app_id: str) -> None:
     """Removes the app and its dependencies.
 
@@ -88,25 +236,30 @@ def uninstall_app(app_id: str) -> None:
     logger.info(f"Uninstalling app {app_id}")
     try:
         # remove the app directory, which also removes the virtual environment
-        if app_path.exists():
-            subprocess.run(["rm", "-rf", app_path])
+        fast_rmtree(app_path)
     except Exception as e:
         logger.error(f"Failed to uninstall app {app_id}: {e}")
-        # clean up the app directory
-        if app_path.exists():
-            shutil.rmtree(app_path)
+        # clean up whatever is left of the app directory
+        shutil.rmtree(app_path, ignore_errors=True)
         crud.report_failed_app_uninstall(app_id, AppFailedToUninstallException(str(e)))
+    # the app is gone either way, so failing to prune its template doesn't
+    # fail the uninstall
+    try:
+        prune_templates()
+    except Exception as e:
+        logger.error(f"Failed to prune virtual environment templates: {e}")
     crud.remove_app(app_id)
     crud.set_node_idle()
 
 
-def run_job(job: Job):
-    """Runs the installed app with the given job.
+def execute_job(job: Job) -> Result:
+    """Runs the installed app with the given job and returns its result,
+    without reporting it. The node's state is left to the caller, so this
+    can run in a worker process.
 
     Args:
         job (Job): the job to run
     """
-    crud.set_node_busy()
     logger.info(f"Running job {job.id} with app {job.app_id}")
     app_path = get_app_directory() / job.app_id
     input_path = app_path / "input"
@@ -114,22 +267,21 @@ def run_job(job: Job):
 
     start_time = 0
     end_time = 0
-    process = None
+    # the app's output goes to unlinked temporary files, not pipes, so it
+    # can't fill memory no matter how much a chatty app writes
+    stdout = tempfile.TemporaryFile()
+    stderr = tempfile.TemporaryFile()
 
     try:
         if not app_path.exists():
-            logger.error(f"App {job.app_id} is not installed")
-            crud.set_node_idle()
-            return
+            raise FileNotFoundError(f"App {job.app_id} is not installed")
 
-        # ensure the input and output directories exist
-        if input_path.exists():
-            shutil.rmtree(input_path)
+        # ensure the input and output directories exist and are empty
         input_path.mkdir(exist_ok=True)
+        clear_directory(input_path)
 
-        if output_path.exists():
-            shutil.rmtree(output_path)
         output_path.mkdir(exist_ok=True)
+        clear_directory(output_path)
 
         # download the input files
         download_files(job.files or [], input_path)
@@ -151,26 +303,27 @@ def run_job(job: Job):
         logger.info(f"Running command: {' '.join(command)}")
 
         # run the app in the app directory
-        start_time = time.time()
-
-        # async live capture the output
-        process = subprocess.Popen(
-            command,
-            cwd=app_path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
+        start_time = time.perf_counter()
 
-        # wait for the process to finish
-        while process.poll() is None:
-            time.sleep(1)
+        # wait returns as soon as the app exits
+        process = subprocess.Popen(command, cwd=app_path, stdout=stdout, stderr=stderr)
+        timed_out = False
+        try:
+            process.wait(timeout=job.time_to_give_up)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            timed_out = True
 
-        end_time = time.time()
+        end_time = time.perf_counter()
 
         success = True
         error = None
-        if process.returncode != 0:
+        if timed_out:
+            logger.error(f"Job {job.id} timed out after {job.time_to_give_up}s")
+            success = False
+            error = f"Job timed out after {job.time_to_give_up} seconds"
+        elif process.returncode != 0:
             logger.error(f"Job {job.id} failed with exit code {process.returncode}")
             success = False
             error = f"Job failed with exit code {process.returncode}"
@@ -181,29 +334,28 @@ def run_job(job: Job):
         if not output_path.exists():
             output_path.mkdir(exist_ok=True)
 
-        # iterate over the output files and upload them
-        output_files = list(output_path.iterdir())
-        file_ids = upload_files(output_files, output_path)
+        # upload the output files, including those in subdirectories, which
+        # keep their path relative to the output directory
+        file_ids = upload_files(list_files(output_path), output_path)
 
     except Exception as e:
         logger.error(f"Job {job.id} failed: {e}")
         success = False
         error = str(e)
         file_ids = []
-        if not end_time:
-            # end_time = time.process_time() # this may be wrong
-            end_time = time.time()  # swapped to this
+        if start_time and not end_time:
+            end_time = time.perf_counter()
 
     finally:
         # remove the input and output directory contents, if it exists
         if input_path.exists():
-            shutil.rmtree(input_path)
+            clear_directory(input_path)
         if output_path.exists():
-            shutil.rmtree(output_path)
+            clear_directory(output_path)
 
-        stdout_str = process.stdout.read() if process and process.stdout else ""
-        stderr_str = process.stderr.read() if process and process.stderr else ""
-        output = f"{stdout_str}\n{stderr_str}"
+        output = f"{read_output(stdout)}\n{read_output(stderr)}"
+        stdout.close()
+        stderr.close()
 
         result = Result(
             job_id=job.id,
@@ -213,87 +365,26 @@ def run_job(job: Job):
             output=output,
             file_ids=file_ids,
         )
-        crud.upload_result(result)
-        crud.set_job_finished(job)
-        crud.set_node_idle()
+    return result
 
 
-def get_app_directory() -> Path:
-    app_dir = Path(config.host.app_dir)
-    app_dir.mkdir(exist_ok=True, parents=True)
-    return app_dir
-
-
-def get_installed_apps() -> list[str]:
-    # get the list of currently installed apps
-    # app_dir contains folders with the app ids
-    return [d.name for d in get_app_directory().iterdir() if d.is_dir()]
-
-
-def download_files(files: list[File], path: Path):
-    """Downloads the files to the given path.
+def finish_job(job: Job, result: Result) -> None:
+    """Reports the job's result and frees the node for the next job.
 
     Args:
-        files (list[File]): the files to download
-        path (Path): the path to save the files
+        job (Job): the finished job
+        result (Result): the job's result
     """
-    file_map = {f.id: f for f in files}
-    urls = [f"{config.router_url}/file/{f.id}" for f in files]
-    # show a progress bar for each file
-    responses = thread_map(
-        lambda url: httpx.get(
-            url,
-            follow_redirects=True,
-            verify=False,
-            timeout=10,
-        ),
-        urls,
-    )
-    for url, response in zip(urls, responses):
-        fle = file_map[url.split("/")[-1]]
-        file_path = path / fle.path if fle.path else path
-        with open(file_path / fle.name, "wb") as f:
-            f.write(response.content)
-    return
-
-
-def upload_files(paths: list[Path], root: Path) -> list[str]:
-    """Uploads files to the router.
-
-    Args:
-        paths (list[Path]): the paths to the files to upload
-        root (Path): the root directory of the files
-    """
-    url = f"{config.router_url}/file"
-
-    files = []
-    for path in paths:
-        if not path.exists() and path.is_file():
-            print(f"File {path} does not exist")
-            continue
-        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-        files.append(
-            ("file", (str(path.relative_to(root)), open(path, "rb"), content_type))
-        )
-    if not files:
-        return []
     try:
-        response = httpx.post(
-            url,
-            files=files,
-            headers={"X-ETH-ADDRESS": config.node.eth_address},
-            verify=False,
-            timeout=None,
-        )
-        if response.status_code != 201:
-            print("Failed to upload files")
-            print(response.text)
-            return []
-        return [item["id"] for item in response.json()]
-    except Exception as e:
-        print("Failed to upload files")
-        print(e)
-        return []
+        crud.upload_result(result)
+        crud.set_job_finished(job)
     finally:
-        for _, (_, f, _) in files:
-            f.close()
+        crud.set_node_idle()
+
+
+def read_output(output: BinaryIO) -> str:
+    # only the end of a chatty job's output, where its errors are, is read
+    # and sent back
+    size = output.seek(0, os.SEEK_END)
+    output.seek(max(0, size - MAX_OUTPUT_BYTES))
+    return output.read().decode(errors="replace")
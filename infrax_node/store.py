@@ -1,18 +1,29 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
-from .node import get_app_directory
+from .util import get_installed_apps
 from .types import Job, Node, NodeState
 
 
 class Store(BaseModel):
     node: Node | None = None
+    # the router path of this node, set once the node has registered
+    node_path: str | None = None
     state: NodeState = NodeState.IDLE
     job: Job | None = None
+    # the installed apps are only rescanned after an app was added or removed
+    _apps_version: int = PrivateAttr(default=0)
+    _app_ids: tuple[int, set[str]] | None = PrivateAttr(default=None)
 
     @property
     def app_ids(self) -> set[str]:
-        app_dir = get_app_directory()
-        return {d.name for d in app_dir.iterdir() if d.is_dir()}
+        version = self._apps_version
+        if self._app_ids is None or self._app_ids[0] != version:
+            self._app_ids = (version, set(get_installed_apps()))
+        return self._app_ids[1]
+
+    def apps_changed(self) -> None:
+        """Marks the installed apps as changed, so app_ids rescans them."""
+        self._apps_version += 1
 
 
 store = Store()
@@ -4,21 +4,27 @@ from enum import Enum
 from typing import Any
 
 from pydantic import BaseModel, Field
+from pydantic.dataclasses import dataclass
 
 
-class Config(BaseModel):
+# the config types are read on every request path, so they are slotted
+# dataclasses: attribute reads hit a slot instead of an instance dict
+@dataclass(slots=True, kw_only=True)
+class Config:
     router_url: str
     host: Host
     node: NodeDef
 
 
-class Host(BaseModel):
+@dataclass(slots=True, kw_only=True)
+class Host:
     external_port: int
     local_only: bool = False
     app_dir: str
 
 
-class NodeDef(BaseModel):
+@dataclass(slots=True, kw_only=True)
+class NodeDef:
     eth_address: str
     spec: Spec
     cpu: str | None = None
@@ -54,7 +60,8 @@ class App(BaseModel):
     files: list[File]
 
 
-class Spec(BaseModel):
+@dataclass(slots=True, kw_only=True)
+class Spec:
     ram: int
     vram: int
     FP80: bool | None = False
@@ -0,0 +1,412 @@
+from __future__ import annotations
+
+import asyncio
+import atexit
+import mimetypes
+import os
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache
+from pathlib import Path
+
+import httpx
+from loguru import logger
+
+from .client import FILE_TRANSFER_LIMITS, get_client, new_async_client, per_process
+from .config import config
+from .exceptions import FilesFailedToUploadException
+from .types import File
+
+# downloads are written to disk in chunks of this size, so memory use stays
+# flat no matter how large the downloaded files are
+CHUNK_SIZE = 1 << 20
+
+# at most this many downloads are in flight at once, which bounds the open
+# files and HTTP/2 streams of large apps
+MAX_CONCURRENT_DOWNLOADS = 64
+
+# output files are uploaded in batches of at most this many files and bytes
+UPLOAD_BATCH_FILES = 16
+UPLOAD_BATCH_BYTES = 64 << 20
+
+# more small files than fit in one batch are sent as a single tar stream
+# instead, which the router unpacks, unless it doesn't accept tar uploads
+TAR_UPLOAD_MAX_BYTES = 256 << 20
+_TAR_HEADERS = {"Content-Type": "application/x-tar"}
+_tar_uploads = True
+
+# a file that goes out on its own is sent as the raw request body, which
+# skips the multipart encoding, unless the router doesn't accept raw uploads
+_raw_uploads = True
+
+_thread_local = threading.local()
+
+# concurrent uploads share one pool instead of creating a new one per call
+TRANSFER_WORKERS = 32
+
+# read the system mime type tables now, instead of lazily on the first upload
+# from inside a worker thread
+mimetypes.init()
+
+
+def get_app_directory() -> Path:
+    return _app_directory(config.host.app_dir)
+
+
+@lru_cache
+def _app_directory(app_dir: str) -> Path:
+    # keyed on the configured path, so the directory is created only once
+    # for each app_dir rather than on every call
+    path = Path(app_dir)
+    path.mkdir(exist_ok=True, parents=True)
+    return path
+
+
+def clear_directory(directory: Path) -> None:
+    """Empties the directory but keeps the directory itself, so it doesn't
+    have to be recreated.
+
+    Args:
+        directory (Path): the directory to empty
+    """
+    # walk bottom-up so every directory is already empty when it's removed.
+    # Entries are removed by path, skipping the open, lstat and fstat of
+    # every directory shutil.rmtree does to guard against symlink swaps,
+    # which can't happen in directories only the node writes to
+    for root, dirs, files in os.walk(directory, topdown=False):
+        for name in files:
+            os.unlink(os.path.join(root, name))
+        for name in dirs:
+            subdirectory = os.path.join(root, name)
+            # symlinked directories are listed but not walked into
+            if os.path.islink(subdirectory):
+                os.unlink(subdirectory)
+            else:
+                os.rmdir(subdirectory)
+
+
+def fast_rmtree(directory: Path) -> None:
+    """Removes the directory and everything in it.
+
+    Args:
+        directory (Path): the directory to remove
+    """
+    clear_directory(directory)
+    os.rmdir(directory)
+
+
+def get_installed_apps() -> list[str]:
+    # get the list of currently installed apps
+    # app_dir contains folders with the app ids, and hidden folders of the
+    # node's own, like the virtual environment templates
+    with os.scandir(get_app_directory()) as entries:
+        return [
+            e.name
+            for e in entries
+            if e.is_dir(follow_symlinks=False) and not e.name.startswith(".")
+        ]
+
+
+def list_files(directory: Path) -> list[Path]:
+    """Lists the files in the directory and all of its subdirectories.
+
+    Args:
+        directory (Path): the directory to list
+    """
+    return [Path(root, name) for root, _, names in os.walk(directory) for name in names]
+
+
+def download_files(files: list[File], path: Path):
+    """Downloads the files to the given path.
+
+    Args:
+        files (list[File]): the files to download
+        path (Path): the path to save the files
+    """
+    runner, async_client = _thread_downloader()
+    runner.run(_download_files(async_client, files, path))
+
+
+def _thread_downloader() -> tuple[asyncio.Runner, httpx.AsyncClient]:
+    # each worker thread keeps its own event loop and client, so downloads
+    # made from the same thread reuse its warm connections to the router.
+    # A forked process inherits the forking thread's locals, hence the pid
+    if getattr(_thread_local, "pid", None) != os.getpid():
+        _thread_local.pid = os.getpid()
+        _thread_local.runner = asyncio.Runner()
+        _thread_local.async_client = new_async_client(FILE_TRANSFER_LIMITS)
+    return _thread_local.runner, _thread_local.async_client
+
+
+async def _download_files(
+    async_client: httpx.AsyncClient, files: list[File], path: Path
+):
+    downloaded: list[Path] = []
+    directories: set[Path] = set()
+    slots = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+    async def download(fle: File):
+        async with slots:
+            file_path = (path / fle.path if fle.path else path) / fle.name
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            # write to a .part file and only move it into place once it is
+            # complete, so an interrupted download never leaves a partial file
+            # behind under the real name
+            part_path = file_path.with_name(f"{file_path.name}.part")
+            try:
+                async with async_client.stream("GET", f"/file/{fle.id}") as response:
+                    response.raise_for_status()
+                    with open(part_path, "wb") as f:
+                        # write off the event loop so disk latency overlaps with
+                        # the network reads of the other downloads
+                        async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                            await asyncio.to_thread(f.write, chunk)
+                os.replace(part_path, file_path)
+            except BaseException:
+                part_path.unlink(missing_ok=True)
+                raise
+            downloaded.append(file_path)
+            directories.add(file_path.parent)
+
+    # one client multiplexes every download over a shared HTTP/2 connection.
+    # The task group cancels and awaits the other downloads when one fails,
+    # so none of them are left on the thread's loop to resume during its
+    # next download_files call
+    try:
+        async with asyncio.TaskGroup() as downloads:
+            for fle in files:
+                downloads.create_task(download(fle))
+    except ExceptionGroup as group:
+        raise group.exceptions[0] from None
+
+    # once every download is in, flush the new files' data in one pass, then
+    # persist their renames with one fsync per directory, so the files are
+    # durable under their real names when download_files returns
+    await asyncio.to_thread(_sync_files, downloaded)
+    for directory in directories:
+        await asyncio.to_thread(_sync_directory, directory)
+
+
+def _sync_files(paths: list[Path]) -> None:
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+
+
+def _sync_directory(directory: Path) -> None:
+    fd = os.open(directory, os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@per_process
+def transfer_pool() -> ThreadPoolExecutor:
+    """Returns the thread pool file transfers run on. Like the clients, it is
+    created per process, since a forked child can't use the parent's threads.
+    """
+    pool = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS, thread_name_prefix="io")
+    atexit.register(pool.shutdown)
+    return pool
+
+
+def guess_content_type(path: Path) -> str:
+    # guess_type only looks at the last suffix, and at the one before it
+    # when the last is an encoding like the .gz of .tar.gz, so names like
+    # model.v2.bin share the cache entry of .bin
+    suffixes = [suffix.lower() for suffix in path.suffixes[-2:]]
+    if suffixes and suffixes[-1] not in mimetypes.encodings_map:
+        suffixes = suffixes[-1:]
+    return _guess_content_type("".join(suffixes))
+
+
+@lru_cache(maxsize=1024)
+def _guess_content_type(suffixes: str) -> str:
+    # output files mostly share a handful of suffixes, so cache per suffix.
+    # Suffixes are lowercased, which guess_type falls back to anyway, so
+    # differently cased ones share an entry
+    return mimetypes.guess_type(f"file{suffixes}")[0] or "application/octet-stream"
+
+
+def upload_files(paths: list[Path], root: Path) -> list[str]:
+    """Uploads files to the router, in batches that are sent concurrently.
+
+    Args:
+        paths (list[Path]): the paths to the files to upload
+        root (Path): the root directory of the files
+    """
+    files = []
+    for path in paths:
+        if not path.is_file():
+            logger.warning(f"File {path} does not exist")
+            continue
+        files.append(path)
+    if not files:
+        return []
+    try:
+        if should_upload_tar(files):
+            ids = upload_files_tar(files, root)
+            if ids is not None:
+                return ids
+        batch_ids = list(
+            transfer_pool().map(
+                lambda batch: upload_batch(batch, root), batch_uploads(files)
+            )
+        )
+    except Exception as e:
+        logger.error(f"Failed to upload files: {e}")
+        return []
+    return [file_id for ids in batch_ids for file_id in ids]
+
+
+def should_upload_tar(paths: list[Path]) -> bool:
+    """Whether the files are better sent as one tar stream than in batches.
+
+    Args:
+        paths (list[Path]): the paths to the files to upload
+    """
+    return (
+        _tar_uploads
+        and len(paths) > UPLOAD_BATCH_FILES
+        and sum(path.stat().st_size for path in paths) <= TAR_UPLOAD_MAX_BYTES
+    )
+
+
+def upload_files_tar(paths: list[Path], root: Path) -> list[str] | None:
+    """Uploads the files as a single tar stream, which is written through a
+    pipe while it is being sent, and returns their ids. Returns None when the
+    router doesn't accept tar uploads.
+
+    Args:
+        paths (list[Path]): the paths to the files to upload
+        root (Path): the root directory of the files
+    """
+    global _tar_uploads
+    read_fd, write_fd = os.pipe()
+
+    def write_tar() -> None:
+        try:
+            with os.fdopen(write_fd, "wb") as pipe:
+                with tarfile.open(fileobj=pipe, mode="w|") as tar:
+                    for path in paths:
+                        tar.add(path, arcname=str(path.relative_to(root)))
+        except BrokenPipeError:
+            # the request was abandoned before the whole archive was read
+            pass
+
+    writer = transfer_pool().submit(write_tar)
+    with os.fdopen(read_fd, "rb") as pipe:
+        response = get_client().post(
+            "/file/tar",
+            content=iter(lambda: pipe.read(CHUNK_SIZE), b""),
+            headers=_TAR_HEADERS,
+            timeout=None,
+        )
+    writer.result()
+    if response.status_code in (404, 405, 415):
+        logger.info("Router doesn't accept tar uploads, uploading in batches")
+        _tar_uploads = False
+        return None
+    if response.status_code != 201:
+        raise FilesFailedToUploadException(
+            f"Router responded {response.status_code}: {response.text}"
+        )
+    return [item["id"] for item in response.json()]
+
+
+def batch_uploads(paths: list[Path]) -> list[list[Path]]:
+    """Splits the files, in order, into batches of at most UPLOAD_BATCH_FILES
+    files and UPLOAD_BATCH_BYTES bytes. A file larger than that gets a batch
+    of its own.
+
+    Args:
+        paths (list[Path]): the paths to the files to upload
+    """
+    batches: list[list[Path]] = []
+    batch_bytes = 0
+    for path in paths:
+        size = path.stat().st_size
+        if (
+            not batches
+            or len(batches[-1]) >= UPLOAD_BATCH_FILES
+            or batch_bytes + size > UPLOAD_BATCH_BYTES
+        ):
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append(path)
+        batch_bytes += size
+    return batches
+
+
+def upload_batch(paths: list[Path], root: Path) -> list[str]:
+    """Uploads the files in a single multipart request, streaming each file
+    from disk, and returns their ids. A batch holding a single file is sent
+    raw instead, when the router accepts that.
+
+    Args:
+        paths (list[Path]): the paths to the files to upload
+        root (Path): the root directory of the files
+    """
+    if len(paths) == 1 and _raw_uploads:
+        file_id = upload_file_raw(paths[0], root)
+        if file_id is not None:
+            return [file_id]
+    with ExitStack() as stack:
+        files = [
+            (
+                "file",
+                (
+                    str(path.relative_to(root)),
+                    stack.enter_context(open(path, "rb")),
+                    guess_content_type(path),
+                ),
+            )
+            for path in paths
+        ]
+        response = get_client().post("/file", files=files, timeout=None)
+    if response.status_code != 201:
+        raise FilesFailedToUploadException(
+            f"Router responded {response.status_code}: {response.text}"
+        )
+    return [item["id"] for item in response.json()]
+
+
+def upload_file_raw(path: Path, root: Path) -> str | None:
+    """Uploads the file as the whole request body, with its name and
+    directory in the query, and returns its id. Returns None when the
+    router doesn't accept raw uploads.
+
+    Args:
+        path (Path): the path to the file to upload
+        root (Path): the root directory of the file
+    """
+    global _raw_uploads
+    relative_path = path.relative_to(root)
+    params = {"name": relative_path.name}
+    if relative_path.parent != Path("."):
+        params["path"] = str(relative_path.parent)
+    with open(path, "rb") as f:
+        # httpx sends the file with its size as the Content-Length and
+        # streams it from disk
+        response = get_client().put(
+            "/file/raw",
+            params=params,
+            content=f,
+            headers={"Content-Type": guess_content_type(path)},
+            timeout=None,
+        )
+    if response.status_code in (404, 405):
+        logger.info("Router doesn't accept raw uploads, uploading as multipart")
+        _raw_uploads = False
+        return None
+    if response.status_code != 201:
+        raise FilesFailedToUploadException(
+            f"Router responded {response.status_code}: {response.text}"
+        )
+    return response.json()["id"]
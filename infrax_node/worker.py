@@ -1,15 +1,15 @@
 import logging
-from datetime import datetime
 from multiprocessing import Process, Queue
-from time import sleep
-from typing import Any
+from time import monotonic
 
+from . import crud, node
 from .types import Job, Result
 
 logging.basicConfig(level=logging.INFO)
 
-job_queue = Queue()
-result_queue = Queue()
+# the node runs one job at a time, so neither queue needs room for more
+job_queue = Queue(maxsize=1)
+result_queue = Queue(maxsize=1)
 
 
 class Worker(Process):
@@ -21,34 +21,33 @@ class Worker(Process):
 
     def run(self):
         logging.info("Worker started")
-        while True:
+        # get blocks until a job arrives, so an idle worker doesn't spin.
+        # A None in the inbox tells it to stop
+        while (job := self.inbox.get()) is not None:
+            # execution time comes from the monotonic clock, which wall clock
+            # (NTP) adjustments can't skew
+            start_time = monotonic()
             try:
-                if self.inbox.empty():
-                    continue
-                if job := self.inbox.get():
-                    result = Result(
-                        job_id=job.id,
-                        execution_time=0,
-                        output=None,
-                        success=True,
-                        error=None,
-                    )
-                    start_ts = int(datetime.now().timestamp())
-                    try:
-                        work_results = self.do_work(job)
-                        result.output = work_results
-                    except Exception as e:
-                        result.error = str(e)
-                        result.success = False
-                    finally:
-                        end_ts = int(datetime.now().timestamp())
-                        result.execution_time = end_ts - start_ts
-                        self.outbox.put((job, result))
+                result = self.do_work(job)
             except Exception as e:
-                print(e)
-            sleep(1)
+                result = Result(
+                    job_id=job.id,
+                    execution_time=monotonic() - start_time,
+                    output=None,
+                    success=False,
+                    error=str(e),
+                )
+            self.outbox.put((job, result))
+        logging.info("Worker stopped")
 
-    def do_work(self, job: Job) -> Any:
-        # simulate work
-        sleep(5)
-        return "result"
+    def stop(self):
+        """Asks the worker to stop once it has finished the jobs already
+        in its inbox."""
+        self.inbox.put(None)
+
+    def do_work(self, job: Job) -> Result:
+        result = node.execute_job(job)
+        # the node process reports the result, so the job's state updates
+        # from this process have to reach the router first
+        crud.flush_state_updates()
+        return result
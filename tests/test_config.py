@@ -0,0 +1,121 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from infrax_node import config
+
+CONFIG = """\
+router_url = "http://router"
+
+[host]
+external_port = 8000
+app_dir = "/tmp/apps"
+
+[compute_node]
+eth_address = "0x1234567890abcdef"
+ram = "16GB"
+vram = "8GB"
+
+[float_types]
+FP32 = true
+"""
+
+
+@pytest.fixture
+def parses(monkeypatch: pytest.MonkeyPatch) -> list[Path]:
+    """Records every time a config file is actually parsed."""
+    parsed: list[Path] = []
+    parse_config = config.parse_config
+
+    def parse(path: Path):
+        parsed.append(path)
+        return parse_config(path)
+
+    monkeypatch.setattr("infrax_node.config.parse_config", parse)
+    return parsed
+
+
+# An unchanged config is loaded from the cache without parsing it again
+def test_load_config_uses_cache(parses: list[Path], tmp_path: Path):
+    # Arrange
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+
+    # Act
+    first = config.load_config(path)
+    second = config.load_config(path)
+
+    # Assert
+    assert parses == [path]
+    assert second == first
+    assert second.host.external_port == 8000
+
+
+# A config whose mtime changed is parsed again
+def test_load_config_reparses_after_mtime_change(parses: list[Path], tmp_path: Path):
+    # Arrange
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    config.load_config(path)
+    path.write_text(CONFIG.replace("8000", "9000"))
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    # Act
+    loaded = config.load_config(path)
+
+    # Assert
+    assert parses == [path, path]
+    assert loaded.host.external_port == 9000
+
+
+# A config whose size changed is parsed again, even with the same mtime
+def test_load_config_reparses_after_size_change(parses: list[Path], tmp_path: Path):
+    # Arrange
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    config.load_config(path)
+    mtime_ns = path.stat().st_mtime_ns
+    path.write_text(CONFIG.replace("8000", "18000"))
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+    # Act
+    loaded = config.load_config(path)
+
+    # Assert
+    assert parses == [path, path]
+    assert loaded.host.external_port == 18000
+
+
+# An unreadable cache just means parsing the config
+def test_load_config_ignores_broken_cache(parses: list[Path], tmp_path: Path):
+    # Arrange
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    path.with_name("config.toml.pkl").write_bytes(b"not a pickle")
+
+    # Act
+    loaded = config.load_config(path)
+
+    # Assert
+    assert parses == [path]
+    assert loaded.router_url == "http://router"
+
+
+# A cache written by different parsing code is ignored
+def test_load_config_ignores_cache_from_other_code(
+    monkeypatch: pytest.MonkeyPatch, parses: list[Path], tmp_path: Path
+):
+    # Arrange
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    config.load_config(path)
+    monkeypatch.setattr("infrax_node.config.config_cache_version", lambda: "other")
+
+    # Act
+    config.load_config(path)
+    config.load_config(path)
+
+    # Assert
+    assert parses == [path, path]
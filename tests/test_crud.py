@@ -0,0 +1,195 @@
+import json
+
+import httpx
+import pytest
+
+from infrax_node import crud
+from infrax_node.types import Job, JobState, Node, NodeState, Result
+
+ETH_ADDRESS = "0x1234567890abcdef"
+ROUTER_URL = "http://router"
+NODE_ID = "NODE_ID"
+
+
+def create_job(job_id: str = "JOB_ID") -> Job:
+    return Job(
+        id=job_id,
+        app_id="APP_ID",
+        eth_address=ETH_ADDRESS,
+        state=JobState.CREATED,
+        start_ts=None,
+        ts=0,
+        last_modified=0,
+    )
+
+
+@pytest.fixture
+def sent(monkeypatch: pytest.MonkeyPatch):
+    """Records every request sent to the router, in the order they arrive,
+    and gives the tests a fresh state sender to send them with."""
+    requests: list[httpx.Request] = []
+
+    async def handle_async(request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        requests.append(request)
+        return httpx.Response(200)
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200)
+
+    monkeypatch.setattr(
+        "infrax_node.crud.new_async_client",
+        lambda: httpx.AsyncClient(
+            base_url=ROUTER_URL, transport=httpx.MockTransport(handle_async)
+        ),
+    )
+    client = httpx.Client(base_url=ROUTER_URL, transport=httpx.MockTransport(handle))
+    monkeypatch.setattr("infrax_node.crud.get_client", lambda: client)
+    # make sure every update in a test lands in one batch
+    monkeypatch.setattr("infrax_node.crud.STATE_BATCH_WINDOW", 0.2)
+
+    sender = crud.StateSender()
+    monkeypatch.setattr("infrax_node.crud.state_sender", lambda: sender)
+    yield requests
+    sender.close()
+
+
+# Updates to the same url queued within one batch window are coalesced, so
+# only the latest state is sent
+def test_state_updates_are_coalesced(sent: list[httpx.Request]):
+    # Arrange
+    job = create_job()
+
+    # Act
+    for state in (JobState.WORKING, JobState.FINISHING, JobState.FINISHED):
+        crud.set_job_state(job, state)
+    crud.flush_state_updates(timeout=5)
+
+    # Assert
+    assert [r.url.path for r in sent] == ["/job/JOB_ID"]
+    assert json.loads(sent[0].content)["state"] == JobState.FINISHED
+
+
+# Each url gets its own update, and every url's latest state is sent, in
+# the order they were submitted
+def test_state_updates_to_different_urls_are_all_sent(sent: list[httpx.Request]):
+    # Arrange
+    jobs = [create_job(f"JOB_{i}") for i in range(3)]
+
+    # Act
+    for job in jobs:
+        crud.set_job_state(job, JobState.WORKING)
+    for job in jobs:
+        crud.set_job_state(job, JobState.FINISHING)
+    crud.flush_state_updates(timeout=5)
+
+    # Assert
+    assert [r.url.path for r in sent] == [f"/job/JOB_{i}" for i in range(3)]
+    assert all(json.loads(r.content)["state"] == JobState.FINISHING for r in sent)
+
+
+# A later batch is only sent after the earlier one, so states never go back
+def test_state_updates_keep_their_order_across_batches(sent: list[httpx.Request]):
+    # Arrange
+    job = create_job()
+
+    # Act
+    crud.set_job_state(job, JobState.WORKING)
+    crud.flush_state_updates(timeout=5)
+    crud.set_job_state(job, JobState.FINISHED)
+    crud.flush_state_updates(timeout=5)
+
+    # Assert
+    states = [json.loads(r.content)["state"] for r in sent]
+    assert states == [JobState.WORKING, JobState.FINISHED]
+
+
+# A coalesced url is sent in the place of its latest update, so the router
+# sees the job finished before the node goes idle
+def test_coalesced_state_updates_keep_latest_order(
+    monkeypatch: pytest.MonkeyPatch, sent: list[httpx.Request]
+):
+    # Arrange
+    node = Node(
+        id=NODE_ID,
+        eth_address=ETH_ADDRESS,
+        state=NodeState.IDLE,
+        host="localhost",
+        spec_id="SPEC_ID",
+        job_id=None,
+    )
+    monkeypatch.setattr(crud.store, "node", node)
+    job = create_job()
+
+    # Act
+    crud.set_node_busy()
+    crud.set_job_state(job, JobState.FINISHED)
+    crud.set_node_idle()
+    crud.flush_state_updates(timeout=5)
+
+    # Assert
+    assert [r.url.path for r in sent] == ["/job/JOB_ID", "/node/state"]
+    assert json.loads(sent[1].content)["state"] == NodeState.IDLE
+
+
+# A finished job's state has reached the router once set_job_finished returns
+def test_set_job_finished_is_sent_before_returning(sent: list[httpx.Request]):
+    # Arrange
+    job = create_job()
+
+    # Act
+    crud.set_job_finished(job)
+
+    # Assert
+    assert [r.url.path for r in sent] == ["/job/JOB_ID"]
+    assert json.loads(sent[0].content)["state"] == JobState.FINISHED
+
+
+# The router must see a job's queued state changes before its result
+def test_upload_result_flushes_state_updates_first(sent: list[httpx.Request]):
+    # Arrange
+    job = create_job()
+    result = Result(job_id=job.id, execution_time=0, success=True)
+
+    # Act
+    crud.set_job_finishing(job)
+    crud.upload_result(result)
+
+    # Assert
+    assert [(r.method, r.url.path) for r in sent] == [
+        ("PUT", "/job/JOB_ID"),
+        ("POST", "/job/JOB_ID/result"),
+    ]
+
+
+# Failed updates are logged rather than stopping the sender
+def test_state_sender_survives_failed_updates(monkeypatch: pytest.MonkeyPatch):
+    # Arrange
+    attempts = 0
+
+    async def handle(request: httpx.Request) -> httpx.Response:
+        nonlocal attempts
+        attempts += 1
+        if attempts == 1:
+            raise httpx.ConnectError("router is down")
+        return httpx.Response(200)
+
+    monkeypatch.setattr(
+        "infrax_node.crud.new_async_client",
+        lambda: httpx.AsyncClient(
+            base_url=ROUTER_URL, transport=httpx.MockTransport(handle)
+        ),
+    )
+    sender = crud.StateSender()
+    job = create_job()
+
+    # Act
+    sender.submit(f"/job/{job.id}", job.model_dump_json())
+    sender.flush(timeout=5)
+    sender.submit(f"/job/{job.id}", job.model_dump_json())
+    sender.flush(timeout=5)
+    sender.close()
+
+    # Assert
+    assert attempts == 2
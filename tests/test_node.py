@@ -0,0 +1,201 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+from infrax_node import node
+from infrax_node.config import config
+from infrax_node.types import App, Job, JobState
+
+ETH_ADDRESS = "0x1234567890abcdef"
+SPEC_ID = "SPEC_ID"
+REQUIREMENTS = "requests==2.32.3  # pinned\n"
+
+
+def create_app(app_id: str) -> App:
+    return App(
+        id=app_id,
+        name=app_id,
+        description=None,
+        spec_id=SPEC_ID,
+        ts=0,
+        last_modified=0,
+        files=[],
+        eth_address=ETH_ADDRESS,
+    )
+
+
+@pytest.fixture
+def builds(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    """Installs apps into a temporary app directory without the router, the
+    apps' files coming from the requirements set by the test. Returns the
+    paths of every virtual environment actually built."""
+    monkeypatch.setattr(config.host, "app_dir", str(tmp_path))
+    requirements = {}
+    built: list[Path] = []
+
+    def download_files(files, app_path: Path):
+        (app_path / "requirements.txt").write_text(requirements[app_path.name])
+
+    def create_venv(app: App, venv_path: Path, requirements: Path):
+        (venv_path / "bin").mkdir(parents=True)
+        (venv_path / "pyvenv.cfg").write_text(f"home = {venv_path}\n")
+        built.append(venv_path)
+
+    def report_failure(app_id: str, error: Exception):
+        # installs and uninstalls swallow their errors, so they'd go
+        # unnoticed otherwise
+        raise error
+
+    for name in ("set_node_busy", "set_node_idle", "add_app", "remove_app"):
+        monkeypatch.setattr(f"infrax_node.crud.{name}", lambda *args: None)
+    monkeypatch.setattr("infrax_node.crud.get_app", create_app)
+    monkeypatch.setattr("infrax_node.crud.report_failed_app_install", report_failure)
+    monkeypatch.setattr("infrax_node.crud.report_failed_app_uninstall", report_failure)
+    monkeypatch.setattr("infrax_node.node.download_files", download_files)
+    monkeypatch.setattr("infrax_node.node.create_venv", create_venv)
+    return requirements, built
+
+
+# Apps with the same requirements build the virtual environment once and
+# hardlink it from the template
+def test_install_app_reuses_template(builds, tmp_path: Path):
+    # Arrange
+    requirements, built = builds
+    requirements["APP_A"] = requirements["APP_B"] = REQUIREMENTS
+
+    # Act
+    node.install_app("APP_A")
+    node.install_app("APP_B")
+
+    # Assert
+    [template] = built
+    assert template.parent == tmp_path / node.TEMPLATE_DIRECTORY
+    assert (template / "pyvenv.cfg").stat().st_nlink == 3
+    for app_id in ("APP_A", "APP_B"):
+        pyvenv = tmp_path / app_id / ".venv" / "pyvenv.cfg"
+        assert pyvenv.samefile(template / "pyvenv.cfg")
+
+
+# Different requirements get different templates
+def test_install_app_templates_differ_by_requirements(builds):
+    # Arrange
+    requirements, built = builds
+    requirements["APP_A"] = REQUIREMENTS
+    requirements["APP_B"] = "httpx==0.27.2\n"
+
+    # Act
+    node.install_app("APP_A")
+    node.install_app("APP_B")
+
+    # Assert
+    assert len(set(built)) == 2
+
+
+# Requirements that refer to the app's own files are installed into the
+# app's virtual environment directly
+@pytest.mark.parametrize("line", ["-e .", "-r base.txt", "./wheels/app.whl"])
+def test_install_app_without_template_for_local_requirements(
+    builds, tmp_path: Path, line: str
+):
+    # Arrange
+    requirements, built = builds
+    requirements["APP_A"] = requirements["APP_B"] = f"{line}\n"
+
+    # Act
+    node.install_app("APP_A")
+    node.install_app("APP_B")
+
+    # Assert
+    assert built == [tmp_path / "APP_A" / ".venv", tmp_path / "APP_B" / ".venv"]
+    assert not (tmp_path / node.TEMPLATE_DIRECTORY).exists()
+
+
+# A template is removed once the last app linked to it is uninstalled
+def test_uninstall_app_prunes_unused_template(builds, tmp_path: Path):
+    # Arrange
+    requirements, built = builds
+    requirements["APP_A"] = requirements["APP_B"] = REQUIREMENTS
+    node.install_app("APP_A")
+    node.install_app("APP_B")
+    [template] = built
+
+    # Act
+    node.uninstall_app("APP_A")
+    kept = template.exists()
+    node.uninstall_app("APP_B")
+
+    # Assert
+    assert kept
+    assert not template.exists()
+    assert not template.with_name(f"{template.name}.ready").exists()
+    assert not (tmp_path / "APP_A").exists()
+    assert not (tmp_path / "APP_B").exists()
+
+
+# Output files in subdirectories are uploaded along with the others
+def test_execute_job_uploads_nested_outputs(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    # Arrange
+    monkeypatch.setattr(config.host, "app_dir", str(tmp_path))
+    app_path = tmp_path / "APP_ID"
+    (app_path / ".venv" / "bin").mkdir(parents=True)
+    (app_path / ".venv" / "bin" / "python").symlink_to(sys.executable)
+    (app_path / "main.py").write_text(
+        "from pathlib import Path\n"
+        "Path('output/sub').mkdir()\n"
+        "Path('output/a.txt').write_text('a')\n"
+        "Path('output/sub/b.txt').write_text('b')\n"
+    )
+    uploaded = []
+
+    def upload_files(paths: list[Path], root: Path) -> list[str]:
+        uploaded.extend(str(path.relative_to(root)) for path in paths)
+        return [f"id-{path.name}" for path in paths]
+
+    monkeypatch.setattr("infrax_node.node.download_files", lambda files, path: None)
+    monkeypatch.setattr("infrax_node.node.upload_files", upload_files)
+    monkeypatch.setattr("infrax_node.crud.set_job_finishing", lambda job: None)
+    job = Job(
+        id="JOB_ID",
+        app_id="APP_ID",
+        eth_address=ETH_ADDRESS,
+        state=JobState.CREATED,
+        start_ts=None,
+        ts=0,
+        last_modified=0,
+    )
+
+    # Act
+    result = node.execute_job(job)
+
+    # Assert
+    assert result.success, result.error
+    assert sorted(uploaded) == ["a.txt", "sub/b.txt"]
+    assert sorted(result.file_ids) == ["id-a.txt", "id-b.txt"]
+
+
+# Failing to prune templates doesn't fail the uninstall of an app that is
+# already gone
+def test_uninstall_app_ignores_prune_errors(
+    monkeypatch: pytest.MonkeyPatch, builds, tmp_path: Path
+):
+    # Arrange
+    requirements, _ = builds
+    requirements["APP_A"] = REQUIREMENTS
+    node.install_app("APP_A")
+    removed = []
+
+    def prune_templates():
+        raise PermissionError("templates are read-only")
+
+    monkeypatch.setattr("infrax_node.node.prune_templates", prune_templates)
+    monkeypatch.setattr("infrax_node.crud.remove_app", removed.append)
+
+    # Act
+    node.uninstall_app("APP_A")
+
+    # Assert
+    assert not (tmp_path / "APP_A").exists()
+    assert removed == ["APP_A"]
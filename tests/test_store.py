@@ -0,0 +1,68 @@
+from pathlib import Path
+
+import httpx
+import pytest
+
+from infrax_node import crud
+from infrax_node.config import config
+from infrax_node.store import Store
+
+ROUTER_URL = "http://router"
+NODE_PATH = "/node/NODE_ID"
+
+
+@pytest.fixture
+def store(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> Store:
+    """A fresh store for crud to use, listing the apps in a temporary app
+    directory, with the router accepting every call."""
+    monkeypatch.setattr(config.host, "app_dir", str(tmp_path))
+    client = httpx.Client(
+        base_url=ROUTER_URL,
+        transport=httpx.MockTransport(lambda r: httpx.Response(200)),
+    )
+    monkeypatch.setattr("infrax_node.crud.get_client", lambda: client)
+    store = Store(node_path=NODE_PATH)
+    monkeypatch.setattr("infrax_node.crud.store", store)
+    return store
+
+
+# The installed apps are scanned once, not on every access
+def test_app_ids_are_cached(store: Store, tmp_path: Path):
+    # Arrange
+    (tmp_path / "APP_A").mkdir()
+    store.app_ids
+
+    # Act
+    (tmp_path / "APP_B").mkdir()
+
+    # Assert
+    assert store.app_ids == {"APP_A"}
+
+
+# Adding an app rescans the installed apps
+def test_app_ids_refresh_after_add_app(store: Store, tmp_path: Path):
+    # Arrange
+    (tmp_path / "APP_A").mkdir()
+    store.app_ids
+    (tmp_path / "APP_B").mkdir()
+
+    # Act
+    crud.add_app("APP_B")
+
+    # Assert
+    assert store.app_ids == {"APP_A", "APP_B"}
+
+
+# Removing an app rescans the installed apps
+def test_app_ids_refresh_after_remove_app(store: Store, tmp_path: Path):
+    # Arrange
+    (tmp_path / "APP_A").mkdir()
+    (tmp_path / "APP_B").mkdir()
+    store.app_ids
+    (tmp_path / "APP_B").rmdir()
+
+    # Act
+    crud.remove_app("APP_B")
+
+    # Assert
+    assert store.app_ids == {"APP_A"}
@@ -0,0 +1,288 @@
+import asyncio
+import io
+import tarfile
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+
+from infrax_node import util
+from infrax_node.types import File
+
+ROUTER_URL = "http://router"
+
+
+def create_files(root: Path, count: int, size: int = 10) -> list[Path]:
+    paths = []
+    for i in range(count):
+        path = root / f"{i:02}.txt"
+        path.write_bytes(b"x" * size)
+        paths.append(path)
+    return paths
+
+
+def multipart_ids(request: httpx.Request) -> list[dict]:
+    # the router answers with one id per uploaded file, in upload order.
+    # Ids are derived from the file names so the tests can check the order
+    body = request.read()
+    names = [part.split(b'"', 1)[0].decode() for part in body.split(b'filename="')[1:]]
+    return [{"id": f"id-{name}"} for name in names]
+
+
+@pytest.fixture
+def router(monkeypatch: pytest.MonkeyPatch):
+    """Serves the upload endpoints. Tests set the status the tar and raw
+    endpoints answer with, and get back the paths of every request."""
+    state = {"tar": 201, "raw": 201, "paths": [], "raw_params": []}
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        state["paths"].append(request.url.path)
+        if request.url.path == "/file/tar":
+            body = request.read()
+            if state["tar"] != 201:
+                return httpx.Response(state["tar"])
+            with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                names = tar.getnames()
+            return httpx.Response(201, json=[{"id": f"id-{n}"} for n in names])
+        if request.url.path == "/file/raw":
+            request.read()
+            state["raw_params"].append(dict(request.url.params))
+            if state["raw"] != 201:
+                return httpx.Response(state["raw"])
+            return httpx.Response(201, json={"id": f"id-{request.url.params['name']}"})
+        ids = multipart_ids(request)
+        # answer the first batch last, so batches finish out of order
+        if ids and ids[0]["id"] == "id-00.txt":
+            time.sleep(0.1)
+        return httpx.Response(201, json=ids)
+
+    client = httpx.Client(base_url=ROUTER_URL, transport=httpx.MockTransport(handle))
+    monkeypatch.setattr("infrax_node.util.get_client", lambda: client)
+    monkeypatch.setattr("infrax_node.util._tar_uploads", True)
+    monkeypatch.setattr("infrax_node.util._raw_uploads", True)
+    return state
+
+
+# Ids come back in the order of the given paths, however the concurrent
+# batches finish
+def test_upload_files_keeps_id_order_across_batches(router: dict, tmp_path: Path):
+    # Arrange
+    util._tar_uploads = False
+    paths = create_files(tmp_path, 40)
+
+    # Act
+    ids = util.upload_files(paths, tmp_path)
+
+    # Assert
+    assert router["paths"] == ["/file"] * 3
+    assert ids == [f"id-{path.name}" for path in paths]
+
+
+# Many small files are sent as one tar stream
+def test_upload_files_sends_many_small_files_as_tar(router: dict, tmp_path: Path):
+    # Arrange
+    paths = create_files(tmp_path, 40)
+
+    # Act
+    ids = util.upload_files(paths, tmp_path)
+
+    # Assert
+    assert router["paths"] == ["/file/tar"]
+    assert ids == [f"id-{path.name}" for path in paths]
+
+
+# A router without tar uploads gets the files in multipart batches, and
+# isn't asked for tar uploads again
+@pytest.mark.parametrize("status_code", [404, 405, 415])
+def test_upload_files_falls_back_from_tar(
+    router: dict, tmp_path: Path, status_code: int
+):
+    # Arrange
+    router["tar"] = status_code
+    paths = create_files(tmp_path, 40)
+
+    # Act
+    first = util.upload_files(paths, tmp_path)
+    second = util.upload_files(paths, tmp_path)
+
+    # Assert
+    assert first == second == [f"id-{path.name}" for path in paths]
+    assert router["paths"].count("/file/tar") == 1
+    assert not util._tar_uploads
+
+
+# Other tar errors fail the upload instead of falling back
+def test_upload_files_tar_error_fails_upload(router: dict, tmp_path: Path):
+    # Arrange
+    router["tar"] = 500
+    paths = create_files(tmp_path, 40)
+
+    # Act
+    ids = util.upload_files(paths, tmp_path)
+
+    # Assert
+    assert ids == []
+    assert util._tar_uploads
+
+
+# Content types are guessed like mimetypes does, from the last suffix and
+# the one before it for encodings like .gz
+@pytest.mark.parametrize(
+    "name, content_type",
+    [
+        ("model.v2.bin", "application/octet-stream"),
+        ("results.JSON", "application/json"),
+        ("a.1.tar.gz", "application/x-tar"),
+        ("image.svgz", "image/svg+xml"),
+        ("README", "application/octet-stream"),
+    ],
+)
+def test_guess_content_type(name: str, content_type: str):
+    # Act
+    guessed = util.guess_content_type(Path(name))
+
+    # Assert
+    assert guessed == content_type
+
+
+# Names that only differ before their last suffix share a cache entry
+def test_guess_content_type_caches_per_suffix():
+    # Arrange
+    util._guess_content_type.cache_clear()
+
+    # Act
+    for name in ("model.v1.bin", "model.v2.bin", "weights.BIN"):
+        util.guess_content_type(Path(name))
+
+    # Assert
+    assert util._guess_content_type.cache_info().currsize == 1
+
+
+# Batches are capped by bytes as well as by files, and a file over the cap
+# gets a batch of its own
+def test_batch_uploads_caps_batch_bytes(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    # Arrange
+    monkeypatch.setattr("infrax_node.util.UPLOAD_BATCH_BYTES", 25)
+    paths = create_files(tmp_path, 3) + [tmp_path / "big.bin"]
+    paths[-1].write_bytes(b"x" * 100)
+
+    # Act
+    batches = util.batch_uploads(paths)
+
+    # Assert
+    assert batches == [paths[:2], paths[2:3], paths[3:]]
+
+
+# A single file is sent raw, with its directory in the query
+def test_upload_files_sends_single_file_raw(router: dict, tmp_path: Path):
+    # Arrange
+    (tmp_path / "sub").mkdir()
+    path = tmp_path / "sub" / "result.json"
+    path.write_text("{}")
+
+    # Act
+    ids = util.upload_files([path], tmp_path)
+
+    # Assert
+    assert router["paths"] == ["/file/raw"]
+    assert router["raw_params"] == [{"name": "result.json", "path": "sub"}]
+    assert ids == ["id-result.json"]
+
+
+# A router without raw uploads gets single files as multipart, and isn't
+# asked for raw uploads again
+@pytest.mark.parametrize("status_code", [404, 405])
+def test_upload_files_falls_back_from_raw(
+    router: dict, tmp_path: Path, status_code: int
+):
+    # Arrange
+    router["raw"] = status_code
+    [path] = create_files(tmp_path, 1)
+
+    # Act
+    first = util.upload_files([path], tmp_path)
+    second = util.upload_files([path], tmp_path)
+
+    # Assert
+    assert first == second == ["id-00.txt"]
+    assert router["paths"] == ["/file/raw", "/file", "/file"]
+    assert not util._raw_uploads
+
+
+# Missing paths are skipped
+def test_upload_files_skips_missing_files(router: dict, tmp_path: Path):
+    # Arrange
+    [path] = create_files(tmp_path, 1)
+
+    # Act
+    ids = util.upload_files([tmp_path / "missing.txt", path], tmp_path)
+
+    # Assert
+    assert ids == ["id-00.txt"]
+
+
+# When one download fails, the others are cancelled rather than left on the
+# thread's loop to finish writing during the next download_files call
+def test_failed_download_cancels_the_others(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    # Arrange
+    async def handle(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/file/missing":
+            return httpx.Response(404)
+        await asyncio.sleep(0.2)
+        return httpx.Response(200, content=b"data")
+
+    runner = asyncio.Runner()
+    client = httpx.AsyncClient(
+        base_url=ROUTER_URL, transport=httpx.MockTransport(handle)
+    )
+    monkeypatch.setattr("infrax_node.util._thread_downloader", lambda: (runner, client))
+    failed_job = tmp_path / "failed"
+    next_job = tmp_path / "next"
+
+    # Act
+    with pytest.raises(httpx.HTTPStatusError):
+        util.download_files(
+            [
+                File(id="missing", name="missing.bin", size=4),
+                File(id="slow", name="stale.bin", size=4),
+            ],
+            failed_job,
+        )
+    util.download_files([File(id="slow", name="input.bin", size=4)], next_job)
+    runner.close()
+
+    # Assert
+    assert not (failed_job / "stale.bin").exists()
+    assert not (failed_job / "stale.bin.part").exists()
+    assert (next_job / "input.bin").read_bytes() == b"data"
+
+
+# Every downloaded file's data is synced, once, before download_files returns
+def test_download_files_syncs_each_file(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+):
+    # Arrange
+    synced = []
+    monkeypatch.setattr(
+        "infrax_node.util.os.fdatasync",
+        lambda fd: synced.append(Path(f"/proc/self/fd/{fd}").resolve()),
+    )
+    runner = asyncio.Runner()
+    client = httpx.AsyncClient(
+        base_url=ROUTER_URL,
+        transport=httpx.MockTransport(lambda r: httpx.Response(200, content=b"data")),
+    )
+    monkeypatch.setattr("infrax_node.util._thread_downloader", lambda: (runner, client))
+    files = [File(id=str(i), name=f"{i}.bin", size=4) for i in range(3)]
+
+    # Act
+    util.download_files(files, tmp_path)
+    runner.close()
+
+    # Assert
+    assert sorted(synced) == [tmp_path.resolve() / f"{i}.bin" for i in range(3)]
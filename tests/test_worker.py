@@ -0,0 +1,154 @@
+import asyncio
+import os
+import signal
+from multiprocessing import Queue
+
+import pytest
+
+from infrax_node import main
+from infrax_node.types import Job, JobState, Result
+from infrax_node.worker import Worker
+
+ETH_ADDRESS = "0x1234567890abcdef"
+TIMEOUT = 10
+
+
+def create_job(job_id: str) -> Job:
+    return Job(
+        id=job_id,
+        app_id="APP_ID",
+        eth_address=ETH_ADDRESS,
+        state=JobState.CREATED,
+        start_ts=None,
+        ts=0,
+        last_modified=0,
+    )
+
+
+def execute_job(job: Job) -> Result:
+    if job.id == "FAILING":
+        raise RuntimeError("app crashed")
+    if job.id == "CRASHING":
+        # like the worker being killed for running out of memory
+        os.kill(os.getpid(), signal.SIGKILL)
+    return Result(job_id=job.id, execution_time=0, output="done", success=True)
+
+
+@pytest.fixture
+def worker(monkeypatch: pytest.MonkeyPatch):
+    """Starts a worker whose jobs run execute_job above. The worker process
+    is forked, so it inherits the patches."""
+    monkeypatch.setattr("infrax_node.worker.node.execute_job", execute_job)
+    monkeypatch.setattr("infrax_node.worker.crud.flush_state_updates", lambda: None)
+    worker = Worker(Queue(), Queue())
+    worker.start()
+    yield worker
+    worker.kill()
+
+
+# Each job sent to the worker comes back with its result
+def test_worker_returns_results(worker: Worker):
+    # Arrange
+    jobs = [create_job("JOB_1"), create_job("JOB_2")]
+
+    # Act
+    results = []
+    for job in jobs:
+        worker.inbox.put(job)
+        results.append(worker.outbox.get(timeout=TIMEOUT))
+
+    # Assert
+    assert [(job.id, result.job_id) for job, result in results] == [
+        ("JOB_1", "JOB_1"),
+        ("JOB_2", "JOB_2"),
+    ]
+    assert all(result.success and result.output == "done" for _, result in results)
+
+
+# A job that raises comes back as a failed result, and the worker carries on
+def test_worker_reports_failed_jobs(worker: Worker):
+    # Arrange
+    worker.inbox.put(create_job("FAILING"))
+    worker.inbox.put(create_job("JOB_1"))
+
+    # Act
+    _, failed = worker.outbox.get(timeout=TIMEOUT)
+    _, succeeded = worker.outbox.get(timeout=TIMEOUT)
+
+    # Assert
+    assert not failed.success
+    assert failed.error == "app crashed"
+    assert succeeded.success
+
+
+# A stopped worker finishes the jobs already in its inbox, then exits
+def test_worker_stops_after_queued_jobs(worker: Worker):
+    # Arrange
+    worker.inbox.put(create_job("JOB_1"))
+
+    # Act
+    worker.stop()
+    _, result = worker.outbox.get(timeout=TIMEOUT)
+    worker.join(timeout=TIMEOUT)
+
+    # Assert
+    assert result.job_id == "JOB_1"
+    assert worker.exitcode == 0
+
+
+# The node reports each result the worker sends back, keeps going when
+# reporting one fails, and stops at the None sentinel
+def test_report_results_finishes_each_job(
+    monkeypatch: pytest.MonkeyPatch, worker: Worker
+):
+    # Arrange
+    finished = []
+
+    def finish_job(job: Job, result: Result):
+        finished.append(job.id)
+        if job.id == "JOB_1":
+            raise RuntimeError("router is down")
+
+    for job_id in ("JOB_1", "JOB_2"):
+        job = create_job(job_id)
+        worker.outbox.put((job, execute_job(job)))
+    worker.outbox.put(None)
+    monkeypatch.setattr("infrax_node.main.result_queue", worker.outbox)
+    monkeypatch.setattr("infrax_node.main.node.finish_job", finish_job)
+
+    # Act
+    asyncio.run(asyncio.wait_for(main.report_results(worker), TIMEOUT))
+
+    # Assert
+    assert finished == ["JOB_1", "JOB_2"]
+
+
+# When the worker process dies, its job is reported failed and the node
+# shuts down, instead of waiting for a result that never comes
+def test_report_results_fails_job_of_dead_worker(
+    monkeypatch: pytest.MonkeyPatch, worker: Worker
+):
+    # Arrange
+    finished = []
+    signals = []
+    job = create_job("CRASHING")
+    monkeypatch.setattr("infrax_node.main.WORKER_CHECK_INTERVAL", 0.05)
+    monkeypatch.setattr("infrax_node.main.result_queue", worker.outbox)
+    monkeypatch.setattr(
+        "infrax_node.main.node.finish_job",
+        lambda job, result: finished.append((job.id, result)),
+    )
+    monkeypatch.setattr("infrax_node.main.signal.raise_signal", signals.append)
+    monkeypatch.setattr(main.store, "job", job)
+
+    # Act
+    worker.inbox.put(job)
+    asyncio.run(asyncio.wait_for(main.report_results(worker), TIMEOUT))
+
+    # Assert
+    [(job_id, result)] = finished
+    assert job_id == "CRASHING"
+    assert not result.success
+    assert result.error == f"Worker process died with exit code {-signal.SIGKILL}"
+    assert signals == [signal.SIGTERM]
+    assert main.store.job is None